@@ -8,8 +8,10 @@ import numpy as np
 import collections
 from scipy.stats import norm
 import argparse
-import pickle
 from agent import State, Action
+from q_function import load_q_function
+import util
+import torch
 import dateutil
 from sklearn.manifold import TSNE
 import altair
@@ -136,8 +138,7 @@ def compare_learning_algorithms(config):
     data_points = collections.defaultdict(list)
 
     for path in results:
-        with open(path, 'rb') as f:
-            r = pickle.load(f)
+        r = util.load_pickle_log(path)
 
         for p in r:
             algorithm, domain = p['name'], p['domain']
@@ -212,8 +213,7 @@ def analyze_user_study(config):
         print()
 
 def load_run_output(path: str):
-    with open(path, 'rb') as pkl:
-        results = pickle.load(pkl)
+    results = util.load_pickle_log(path)
 
     return [{'algorithm': r['name'],
              'run_index': r.get('run_index', 0),
@@ -238,8 +238,8 @@ def make_plot(data: list[dict], plot_id: str):
     return altair.Chart.from_dict(plot_spec)
 
 def embed_problems_tsne(model_path: str, problems: list[dict]) -> list[(float, float)]:
-    model = torch.load(model_path)
     device = torch.device('cpu')
+    model = load_q_function(model_path, device)
     model.to(device)
     embeddings = model.embed_states([State([p['problem']], [], 0.0) for p in problems]).numpy()
     tsne = TSNE()
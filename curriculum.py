@@ -2,7 +2,9 @@
 
 import argparse
 import json
+import os
 import torch
+import torch.multiprocessing as mp
 import random
 import pickle
 import matplotlib
@@ -13,20 +15,48 @@ from tqdm import tqdm
 import numpy as np
 from flask import Flask, request
 
-from q_function import QFunction, DRRN, StateRNNValueFn
+from q_function import QFunction, DRRN, StateRNNValueFn, load_q_function
 from environment import Environment
 
 
 def l2_distance(u, v):
     return np.sqrt(np.sum((u - v)**2))
 
-def find_all_solutions(env, problems, q_fn, max_steps):
+# Per-process state of the workers used by find_all_solutions.
+_worker_env, _worker_q_fn, _worker_max_steps = None, None, None
+
+def _init_solver_worker(config, q_fn, max_steps):
+    global _worker_env, _worker_q_fn, _worker_max_steps
+    _worker_env = Environment.from_config(config)
+    _worker_q_fn = q_fn
+    _worker_max_steps = max_steps
+
+def _solve_one(problem):
+    with torch.inference_mode():
+        success, history = _worker_q_fn.rollout(_worker_env, problem, _worker_max_steps)
+    # Only send back what the caller needs, rather than the whole search history.
+    return success, _worker_q_fn.recover_solutions(history) if success else []
+
+def find_all_solutions(env, problems, q_fn, max_steps, config=None, n_workers=1):
+    '''Tries to solve each problem with its own rollout. With n_workers > 1, problems are
+    split among that many processes, each with its own environment (created from config)
+    and sharing the Q-function's parameters.'''
     problems_with_solution = []
 
-    for p in tqdm(problems):
-        success, history = q_fn.rollout(env, p, max_steps)
+    if n_workers > 1:
+        if q_fn.device is None or torch.device(q_fn.device).type == 'cpu':
+            q_fn.share_memory()
+        ctx = mp.get_context('spawn')
+        with ctx.Pool(n_workers, _init_solver_worker, (config, q_fn, max_steps)) as pool:
+            results = list(tqdm(pool.imap(_solve_one, problems), total=len(problems)))
+    else:
+        results = []
+        for p in tqdm(problems):
+            success, history = q_fn.rollout(env, p, max_steps)
+            results.append((success, q_fn.recover_solutions(history) if success else []))
+
+    for p, (success, solutions) in zip(problems, results):
         if success:
-            solutions = q_fn.recover_solutions(history)
             assert len(solutions) > 0
             problems_with_solution.append((p, solutions[0]))
 
@@ -38,21 +68,25 @@ def build_curriculum(config, device):
     radius = config['radius']
 
     env = Environment.from_config(config)
-    q_fn = torch.load(config['q_function'], map_location=device)
+    q_fn = load_q_function(config['q_function'], device)
     q_fn.to(device)
+    q_fn.eval()
 
     print('Fetching problems...')
     problems = [env.generate_new(domain, seed=(i + config.get('seed', 0)))
                 for i in tqdm(range(config['n_problems']))]
 
-    print('Finding solutions...')
-    problems_with_solution = find_all_solutions(env, problems, q_fn, config.get('max_steps', 30))
+    with torch.inference_mode():
+        print('Finding solutions...')
+        # Rollouts are independent, so they can be run in parallel on the CPU.
+        n_workers = config.get('n_workers', os.cpu_count() if device.type == 'cpu' else 1)
+        problems_with_solution = find_all_solutions(env, problems, q_fn, config.get('max_steps', 30),
+                                                    config, n_workers)
 
-    problems, solutions = zip(*problems_with_solution)
+        problems, solutions = zip(*problems_with_solution)
 
-    print(f'Found solutions for {len(problems_with_solution)} problems.')
+        print(f'Found solutions for {len(problems_with_solution)} problems.')
 
-    with torch.no_grad():
         embeddings = q_fn.embed_states(problems)
 
     print('Starting with embeddings matrix', embeddings.shape)
@@ -60,7 +94,7 @@ def build_curriculum(config, device):
     X = TSNE().fit_transform(embeddings) if config.get('tsne') else embeddings
 
     if config.get('normalize'):
-        X /= X.sum(axis=1).reshape(-1, 1)
+        X = X / X.sum(axis=1).reshape(-1, 1)
 
     X = X.cpu()
 
@@ -128,7 +162,7 @@ def build_curriculum(config, device):
     }
 
     with open(config['output'], 'wb') as f:
-        pickle.dump(data, f)
+        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
 
     print('Saved', config['output'])
 
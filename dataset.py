@@ -8,6 +8,7 @@ import argparse
 import json
 import subprocess
 from environment import RustEnvironment
+from q_function import load_q_function
 from tqdm import tqdm
 
 
@@ -106,7 +107,7 @@ class CognitiveTutorDataset(torch.utils.data.Dataset):
 def generate_solutions_dataset(agent, domain, output, device):
     env = RustEnvironment(domain)
     device = torch.device(device)
-    q_fn = torch.load(agent, map_location=device)
+    q_fn = load_q_function(agent, device)
     q_fn.to(device)
 
     dataset = []
@@ -155,10 +156,9 @@ if __name__ == '__main__':
         for entry in ds:
             problems.add(entry['problem'])
         problems = list(problems)
-        with open('input.txt', 'w') as f:
-            f.write('\n'.join(problems))
         print('Making terms canonical...')
         p = subprocess.run(['racket', '-tm', 'canonicalize-terms.rkt'],
+                           input='\n'.join(problems).encode('utf8'),
                            capture_output=True)
         canonical_terms = dict(zip(problems, p.stdout.decode('utf8').split('\n')[:-1]))
         print('Done. example:', repr(problems[0]), '==>', repr(canonical_terms[problems[0]]))
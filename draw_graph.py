@@ -1,13 +1,13 @@
 import sys
 import collections
-import pickle
 import matplotlib.pyplot as plt
 
+import util
+
 def load_data(path):
     data_points = {}
 
-    with open(path, 'rb') as f:
-        r = pickle.load(f)
+    r = util.load_pickle_log(path)
 
     for p in r:
         algorithm, domain = p['name'], p['domain']
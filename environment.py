@@ -62,6 +62,14 @@ def random_initial_seed():
     return random.randint(10**7, 10**8)
 
 
+def load_cpu_q_function(path):
+    'Loads a Q-function checkpoint on the CPU.'
+    # Imported lazily, as q_function imports this module.
+    from q_function import load_q_function
+    device = torch.device('cpu')
+    return load_q_function(path, device).to(device)
+
+
 class Environment:
     'Generic environment back-end'
     def generate_new(self, domain: str, seed: int = None) -> State:
@@ -143,6 +151,11 @@ class RacketEnvironment(Environment):
         return list(zip(rewards, actions))
 
 
+# Goals of every problem generated by the Rust environments. Since it is a tuple,
+# State shares it instead of copying.
+RUST_INITIAL_GOALS = ('',)
+
+
 class RustEnvironment(Environment):
     'Faster environment that calls into the compiled library.'
     def __init__(self, default_domain=None, abstractions=None):
@@ -158,7 +171,7 @@ class RustEnvironment(Environment):
             seed = self.next_seed
             self.next_seed += 1
         problem = commoncore.generate(domain, seed)
-        return State([problem], [''], 0.0)
+        return State([problem], RUST_INITIAL_GOALS, 0.0)
 
 
     def ax_seq_apply(self, ax_seq, state, domain=None, param_so_far=()):
@@ -279,9 +292,7 @@ class MultiTaskEnvironment(Environment):
 
 def interact(environment, scoring_model_path):
     if scoring_model_path:
-        device = torch.device('cpu')
-        model = torch.load(scoring_model_path, map_location=device)
-        model.to(device)
+        model = load_cpu_q_function(scoring_model_path)
     else:
         model = None
 
@@ -320,9 +331,7 @@ def interact(environment, scoring_model_path):
 
 
 def test(environment, scoring_model_path):
-    device = torch.device('cpu')
-    model = torch.load(scoring_model_path, map_location=device)
-    model.to(device)
+    model = load_cpu_q_function(scoring_model_path)
 
     print('Enter a problem, or empty to generate a random one:')
     problem = input('>>> ')
@@ -343,9 +352,7 @@ def test(environment, scoring_model_path):
 
 
 def evaluate(environment, model_path, n_problems=30):
-    device = torch.device('cpu')
-    model = torch.load(model_path, map_location=device)
-    model.to(device)
+    model = load_cpu_q_function(model_path)
     successes = 0
 
     for i in range(n_problems):
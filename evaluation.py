@@ -1,16 +1,25 @@
+import concurrent.futures
+import contextlib
 import datetime
+import io
 import pickle
+import pickletools
 import traceback
 import hashlib
+import itertools
 import os
 import json
 import subprocess
+import time
+import sqlite3
 import copy
 
 import util
 from environment import Environment
-from q_function import InverseLength, RandomQFunction
+from q_function import (InverseLength, RandomQFunction, load_q_function,
+                        q_function_weights_path, serialize_q_function)
 
+import numpy as np
 import torch
 # import wandb
 from tqdm import tqdm
@@ -26,38 +35,74 @@ class SuccessRatePolicyEvaluator:
         self.max_steps = config.get('max_steps', 30)  # Maximum length of an episode.
         self.beam_size = config.get('beam_size', 1)  # Size of the beam in beam search.
         self.debug = config.get('debug', False)  # Whether to print all steps during evaluation.
+        # Whether to search all problems at once (otherwise, runs one rollout per problem).
+        # Off by default since batching can change Q values (see QFunction.rollout_batch).
+        self.batch_rollouts = config.get('batch_rollouts', False)
+        # Maximum number of actions scored in a single forward pass when batching rollouts.
+        self.max_batch_size = config.get('max_batch_size', 1024)
 
     def evaluate(self, q, verbose=False, show_progress=False):
-        successes, failures, solution_lengths = [], [], []
+        successes, failures = [], []
+        # -1 marks problems that were not solved.
+        solution_lengths = np.full(self.n_problems, -1, dtype=np.int32)
         wrapper = tqdm if show_progress else lambda x: x
 
-        for i in wrapper(range(self.n_problems)):
-            problem = self.environment.generate_new(seed=(self.seed + i))
-            success, history = q.rollout(self.environment, problem,
-                                         self.max_steps, self.beam_size, self.debug)
+        problems = [self.environment.generate_new(seed=(self.seed + i))
+                    for i in range(self.n_problems)]
+
+        # The Q function might be in the middle of training, so restore its mode afterwards.
+        was_training = q.training
+        q.eval()
+
+        try:
+            with torch.inference_mode():
+                if self.batch_rollouts:
+                    rollouts = q.rollout_batch(self.environment, problems,
+                                               self.max_steps, self.beam_size, self.debug,
+                                               self.max_batch_size, show_progress)
+                else:
+                    rollouts = [q.rollout(self.environment, problem,
+                                          self.max_steps, self.beam_size, self.debug)
+                                for problem in wrapper(problems)]
+        finally:
+            q.train(was_training)
+
+        for i, (problem, (success, history)) in enumerate(zip(problems, rollouts)):
             if success:
                 successes.append((i, problem))
                 print("SUCCESS:", q.recover_solutions(history))
+                solution_lengths[i] = len(history) - 1
             else:
                 print("FAILURE")
                 failures.append((i, problem))
-            solution_lengths.append(len(history) - 1 if success else -1)
             if verbose:
                 print(i, problem, '-- success?', success)
 
+        solved = solution_lengths >= 0
+
         return {
             'success_rate': len(successes) / self.n_problems,
-            'solution_lengths': solution_lengths,
-            'max_solution_length': max(solution_lengths),
+            'solution_lengths': solution_lengths.tolist(),
+            'max_solution_length': int(solution_lengths.max()),
+            'mean_solution_length': float(solution_lengths[solved].mean()) if solved.any() else 0.0,
             'successes': successes,
             'failures': failures,
         }
 
 
+def _write_bytes(path, data: bytes):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
 class EndOfLearning(Exception):
     '''Exception used to signal the end of the learning budget for an agent.'''
 
 
+# Agent attributes saved in training checkpoints, when the agent has them.
+AGENT_CONTROL_STATE = ['bootstrapping', 'current_depth']
+
+
 class EnvironmentWithEvaluationProxy:
     '''Wrapper around the environment that triggers an evaluation every K calls'''
     def __init__(self, experiment_id: str, run_index: int, agent_name: str, domain: str,
@@ -82,6 +127,10 @@ class EnvironmentWithEvaluationProxy:
         self.begin_time = datetime.datetime.now()
         self.n_checkpoints = 0
 
+        # Checkpoints are serialized on the main thread, but written to disk in the background.
+        self.checkpoint_writer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.pending_writes = []
+
         output_root = os.path.join(config['output_root'], experiment_id, agent_name, domain, f'run{run_index}')
         checkpoint_dir = os.path.join(output_root, 'checkpoints')
 
@@ -95,18 +144,29 @@ class EnvironmentWithEvaluationProxy:
 
     def load_checkpoint(self):
         'Loads an existing training checkpoint, if available.'
-        checkpoint_path = os.path.join(self.checkpoint_dir, 'training-state.pt')
+        checkpoint_path = os.path.join(self.checkpoint_dir, 'training-state.pkl')
 
         if os.path.exists(checkpoint_path):
             print('Training checkpoint exists - restoring...')
+            with open(checkpoint_path, 'rb') as f:
+                previous_state = pickle.load(f)
+            self.n_steps = previous_state['n_steps']
+            self.n_new_problems = previous_state['n_new_problems']
+            self.cumulative_reward = previous_state['cumulative_reward']
+            self.n_checkpoints = previous_state['n_checkpoints']
+
+            # The agent's Q-function is restored from the last per-evaluation checkpoint.
             device = self.agent.q_function.device
-            previous_state = torch.load(checkpoint_path, map_location=device)
-            self.agent = previous_state.agent
-            self.agent.q_function.to(device)
-            self.n_steps = previous_state.n_steps
-            self.n_new_problems = previous_state.n_new_problems
-            self.cumulative_reward = previous_state.cumulative_reward
-            self.n_checkpoints = previous_state.n_checkpoints
+            q = load_q_function(os.path.join(self.checkpoint_dir, f'{self.n_checkpoints - 1}.pt'),
+                                device)
+            self.agent.q_function.load_state_dict(q.state_dict())
+
+            for name, value in previous_state['agent_state'].items():
+                setattr(self.agent, name, value)
+
+            if previous_state['optimizer_state'] is not None:
+                self.agent.optimizer.load_state_dict(
+                    torch.load(io.BytesIO(previous_state['optimizer_state']), map_location=device))
 
     def generate_new(self, domain=None, seed=None):
         self.n_new_problems += 1
@@ -161,44 +221,68 @@ class EnvironmentWithEvaluationProxy:
         print(util.now(), f'Success rate ({name}-{domain}-run{self.run_index}):',
               results['success_rate'], '\tMax length:', results['max_solution_length'])
 
-        try:
-            with open(self.results_path, 'rb') as f:
-                existing_results = pickle.load(f)
-        except Exception as e:
-            print(f'Starting new results log at {self.results_path} ({e})')
-            existing_results = []
-
-        existing_results.append(results)
+        util.append_to_pickle_log(self.results_path, results)
 
-        with open(self.results_path, 'wb') as f:
-            pickle.dump(existing_results, f)
+        # Wait for the previous checkpoint to be flushed before queueing up a new one.
+        self.wait_for_checkpoint_writes()
 
-        torch.save(self.agent.q_function,
-                   os.path.join(self.checkpoint_dir,
-                                f'{self.n_checkpoints}.pt'))
+        for extension, data in serialize_q_function(self.agent.q_function).items():
+            self.write_in_background(os.path.join(self.checkpoint_dir,
+                                                  f'{self.n_checkpoints}{extension}'),
+                                     data)
 
         self.n_checkpoints += 1
 
-        torch.save(self,
-                   os.path.join(self.checkpoint_dir,
-                                'training-state.pt'))
+        state = {
+            'n_steps': self.n_steps,
+            'n_new_problems': self.n_new_problems,
+            'cumulative_reward': self.cumulative_reward,
+            'n_checkpoints': self.n_checkpoints,
+            # Small control state of the agent (e.g. whether it still acts with its bootstrap policy).
+            'agent_state': {name: getattr(self.agent, name)
+                            for name in AGENT_CONTROL_STATE if hasattr(self.agent, name)},
+            'optimizer_state': None,
+        }
+
+        optimizer = getattr(self.agent, 'optimizer', None)
+
+        if optimizer is not None:
+            optimizer_buf = io.BytesIO()
+            torch.save(optimizer.state_dict(), optimizer_buf)
+            state['optimizer_state'] = optimizer_buf.getvalue()
 
+        self.write_in_background(os.path.join(self.checkpoint_dir, 'training-state.pkl'),
+                                 pickletools.optimize(
+                                     pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)))
+
+    def write_in_background(self, path, data: bytes):
+        'Schedules data to be written to path by the checkpoint writer thread.'
+        self.pending_writes.append(self.checkpoint_writer.submit(_write_bytes, path, data))
+
+    def wait_for_checkpoint_writes(self):
+        'Blocks until all scheduled checkpoint writes are on disk.'
+        for future in self.pending_writes:
+            future.result()
+        self.pending_writes = []
 
     def evaluate_agent(self):
         if self.n_checkpoints == 0:  # False when loading an existing training run.
             self.evaluate()
-        while True:
-            try:
-                self.agent.learn_from_environment(self)
-            except EndOfLearning:
-                print('Learning budget ended. Doing last learning round (if agent wants to)')
-                self.agent.learn_from_experience()
-                print('Running final evaluation...')
-                self.evaluate()
-                break
-            except Exception as e:
-                traceback.print_exc(e)
-                print('Ignoring exception and continuing...')
+        try:
+            while True:
+                try:
+                    self.agent.learn_from_environment(self)
+                except EndOfLearning:
+                    print('Learning budget ended. Doing last learning round (if agent wants to)')
+                    self.agent.learn_from_experience()
+                    print('Running final evaluation...')
+                    self.evaluate()
+                    break
+                except Exception as e:
+                    traceback.print_exc(e)
+                    print('Ignoring exception and continuing...')
+        finally:
+            self.wait_for_checkpoint_writes()
 
     def print_progress(self):
         print(util.now(), '{} steps ({:.3}%, ETA: {}), {} total reward, explored {} problems. {}'
@@ -218,9 +302,9 @@ def evaluate_policy(config, device, verbose):
     elif config.get('inverse_length'):
         q = InverseLength()
     else:
-        q = torch.load(config['model_path'], map_location=device)
+        q = load_q_function(config['model_path'], device)
 
-    q.to(device)
+    # load_q_function already places the weights on the device.
     q.device = device
 
     env = Environment.from_config(config)
@@ -236,27 +320,41 @@ def evaluate_policy(config, device, verbose):
     return result['success_rate']
 
 
+def _file_digest(path):
+    with open(path, 'rb') as f:
+        h = hashlib.blake2b()
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+        return h.hexdigest()
+
+
 def evaluate_policy_checkpoints(config, device):
     previous_successes = set()
     checkpoint_path = config['checkpoint_path']
     env = Environment.from_config(config)
     evaluator = SuccessRatePolicyEvaluator(env, config.get('eval_config', {}))
     i = 0
-    last_hash = None
+    last_weights_path, last_size, last_digest = None, None, None
 
     try:
         while True:
             path = checkpoint_path.format(i)
             i += 1
 
-            with open(path, 'rb') as f:
-                h = hashlib.md5(f.read()).hexdigest()
-                if h == last_hash:
+            # Skip checkpoints that are identical to the previous one. Sizes are compared
+            # first, and files are only hashed when they have the same size.
+            weights_path = q_function_weights_path(path)
+            size = os.path.getsize(weights_path)
+            digest = None
+            if size == last_size:
+                if last_digest is None:
+                    last_digest = _file_digest(last_weights_path)
+                digest = _file_digest(weights_path)
+                if digest == last_digest:
                     continue
-                last_hash = h
+            last_weights_path, last_size, last_digest = weights_path, size, digest
             print('Evaluating', path)
-            q = torch.load(path, map_location=device)
-            q.to(device)
+            q = load_q_function(path, device)
             q.device = device
             result = evaluator.evaluate(q, show_progress=True)
 
@@ -276,30 +374,130 @@ def evaluate_policy_checkpoints(config, device):
         print('Checkpoint', i, 'does not exist -- stopping.')
 
 
-def normalize_solutions(solutions: list[list[str]]) -> list[list[str]]:
-    'Uses the Racket parser to syntactically normalize solutions in the equations domain.'
+# On-disk cache of normalized steps. Set SOCRATIC_TUTOR_NORMALIZE_CACHE to change its path,
+# or to an empty string to disable it.
+NORMALIZATION_CACHE_PATH = os.environ.get('SOCRATIC_TUTOR_NORMALIZE_CACHE',
+                                          os.path.expanduser('~/.cache/socratic-tutor/normalize.sqlite'))
+# Least recently used entries are evicted beyond this many.
+NORMALIZATION_CACHE_MAX_ENTRIES = int(os.environ.get('SOCRATIC_TUTOR_NORMALIZE_CACHE_MAX_ENTRIES',
+                                                     10**6))
+# Racket sources that determine the normalization (cache entries are keyed on their contents).
+NORMALIZER_SOURCES = ['canonicalize-terms.rkt', 'term-parser.rkt', 'terms.rkt',
+                      'grammar.rkt', 'debug.rkt']
+
+
+def _normalizer_version():
+    h = hashlib.sha256()
+    for path in NORMALIZER_SOURCES:
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+@contextlib.contextmanager
+def _normalization_cache(path, version):
+    '''Opens the normalization cache as a single transaction, clearing it if it was filled by
+    another version of the normalizer. SQLite's own locking lets concurrent processes share it.'''
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    db = sqlite3.connect(path, timeout=600)
+
+    try:
+        with db:
+            db.execute('CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT)')
+            db.execute('CREATE TABLE IF NOT EXISTS steps (step TEXT PRIMARY KEY, '
+                       'normalized TEXT, last_used INTEGER)')
+            db.execute('CREATE INDEX IF NOT EXISTS steps_last_used ON steps (last_used)')
+
+            if db.execute("SELECT value FROM metadata WHERE key = 'version'").fetchone() != (version,):
+                db.execute('DELETE FROM steps')
+                db.execute("INSERT OR REPLACE INTO metadata VALUES ('version', ?)", (version,))
+
+            yield db
+    finally:
+        db.close()
+
+
+def _lookup_normalized(db, steps):
+    'Returns the cached normalizations of the given steps, marking them as recently used.'
+    found = {}
+    now = time.time_ns()
+    steps = list(steps)
+
+    # Stays below SQLite's limit on the number of query parameters.
+    for i in range(0, len(steps), 500):
+        chunk = steps[i:i + 500]
+        placeholders = ','.join('?' * len(chunk))
+        found.update(db.execute(f'SELECT step, normalized FROM steps WHERE step IN ({placeholders})',
+                                chunk))
+        db.execute(f'UPDATE steps SET last_used = ? WHERE step IN ({placeholders})', [now] + chunk)
+
+    return found
+
+
+def _store_normalized(db, normalized, max_entries):
+    'Adds new normalizations to the cache, then evicts the least recently used entries.'
+    now = time.time_ns()
+    db.executemany('INSERT OR REPLACE INTO steps VALUES (?, ?, ?)',
+                   [(step, n, now) for step, n in normalized.items()])
+    db.execute('DELETE FROM steps WHERE step IN '
+               '(SELECT step FROM steps ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+               (max_entries,))
+
+
+def _run_normalizer(steps):
+    sp = subprocess.run(["racket", "-tm", "canonicalize-terms.rkt"],
+                        input=''.join(l + '\n' for l in steps).encode("utf8"),
+                        capture_output=True)
+    normalized = sp.stdout.decode("utf8").splitlines()
+
+    if sp.returncode != 0 or len(normalized) != len(steps):
+        raise RuntimeError(f'Failed to normalize {len(steps)} steps '
+                           f'(exit code {sp.returncode}, got {len(normalized)} lines): '
+                           + sp.stderr.decode("utf8"))
+
+    return dict(zip(steps, normalized))
+
+
+def normalize_solutions(solutions: list[list[str]],
+                        cache_path=NORMALIZATION_CACHE_PATH,
+                        max_cache_entries=NORMALIZATION_CACHE_MAX_ENTRIES) -> list[list[str]]:
+    '''Uses the Racket parser to syntactically normalize solutions in the equations domain.
+
+    Normalized steps are cached in an LRU SQLite database at cache_path (pass a falsy
+    cache_path to disable it), so only steps that were not seen recently are sent to Racket.'''
     all_steps = []
 
     for s in solutions:
         all_steps.extend(s)
 
-    with open('input.txt', 'w') as f:
-        for l in all_steps:
-            f.write(l)
-            f.write('\n')
+    unique_steps = list(dict.fromkeys(all_steps))
+
+    if not cache_path:
+        normalized = _run_normalizer(unique_steps)
+    else:
+        version = _normalizer_version()
 
-    sp = subprocess.run(["racket", "-tm", "canonicalize-terms.rkt"], capture_output=True)
-    steps = list(filter(None, sp.stdout.decode("utf8").split("\n")))
+        with _normalization_cache(cache_path, version) as db:
+            normalized = _lookup_normalized(db, unique_steps)
 
-    new_solutions = []
-    for s in solutions:
-        new_solutions.append([steps.pop(0) for _ in range(len(s))])
+        uncached = [l for l in unique_steps if l not in normalized]
+
+        if uncached:
+            # Racket runs without holding the cache open.
+            new_entries = _run_normalizer(uncached)
 
-    return new_solutions
+            with _normalization_cache(cache_path, version) as db:
+                _store_normalized(db, new_entries, max_cache_entries)
+
+            normalized.update(new_entries)
+
+    steps_iter = iter(normalized[l] for l in all_steps)
+    return [list(itertools.islice(steps_iter, len(s))) for s in solutions]
 
 
 def normalize_human_solutions(path):
-    human_solutions = json.load(open(path))
+    with open(path) as f:
+        human_solutions = json.load(f)
 
     solutions = []
 
@@ -308,9 +506,11 @@ def normalize_human_solutions(path):
 
     normalized_solutions = normalize_solutions(solutions)
 
+    normalized_iter = iter(normalized_solutions)
+
     for h in human_solutions:
         for i in range(len(h['solutions'])):
-            h['solutions'][i] = normalized_solutions.pop(0)
+            h['solutions'][i] = next(normalized_iter)
 
     with open('normalized_human_solutions.json', 'w') as f:
         json.dump(human_solutions, f)
@@ -1,4 +1,7 @@
+import io
 import math
+import os
+import pickle
 
 from environment import Environment, State, Action
 from util import register
@@ -6,6 +9,13 @@ from encoding import CharEncoding
 
 import torch
 from torch import nn
+from tqdm import tqdm
+
+try:
+    import safetensors.torch
+    SAFETENSORS_AVAILABLE = True
+except ModuleNotFoundError:
+    SAFETENSORS_AVAILABLE = False
 
 
 class QFunction(nn.Module):
@@ -75,6 +85,84 @@ class QFunction(nn.Module):
 
         return success, history
 
+    def rollout_batch(self,
+                      environment: Environment,
+                      states: list[State],
+                      max_steps: int,
+                      beam_size: int = 1,
+                      debug: bool = False,
+                      max_batch_size: int = 1024,
+                      show_progress: bool = False) -> list[tuple[bool, list[list[State]]]]:
+        """Runs beam search as in rollout() from several initial states at once.
+        At each step, the beams of all problems that are still being searched are
+        stepped together, and their actions are scored in chunks of at most
+        max_batch_size. Returns one (success, history) pair per state.
+
+        Note that results are not guaranteed to match rollout(): the recurrent Q
+        functions do not mask padding, so the score of an action can depend on which
+        other actions are in the same chunk."""
+        beams = [[s] for s in states]
+        histories = [[beam] for beam in beams]
+        seen = [set([s]) for s in states]
+        successes = [False] * len(states)
+        active = list(range(len(states)))
+
+        wrapper = tqdm if show_progress else lambda x: x
+
+        for i in wrapper(range(max_steps)):
+            active = [j for j in active if beams[j]]
+
+            if not active:
+                break
+
+            step_results = environment.step([s for j in active for s in beams[j]], debug=debug)
+
+            # Split the results back by problem, dropping the ones that are done.
+            still_active, active_actions = [], []
+            begin = 0
+
+            for j in active:
+                end = begin + len(beams[j])
+                rewards, s_actions = zip(*step_results[begin:end])
+                begin = end
+
+                actions = [a for s_a in s_actions for a in s_a]
+
+                if max(rewards):
+                    if debug:
+                        print("REWARDS:", rewards)
+                        print("NEXT ACTIONS:", s_actions)
+                    successes[j] = True
+                elif len(actions) > 0:
+                    still_active.append(j)
+                    active_actions.append(actions)
+
+            active = still_active
+
+            if not active:
+                break
+
+            all_actions = [a for actions in active_actions for a in actions]
+
+            q_values = []
+
+            with torch.no_grad():
+                for begin in range(0, len(all_actions), max_batch_size):
+                    q_values.extend(self(all_actions[begin:begin + max_batch_size]).tolist())
+
+            for a, v in zip(all_actions, q_values):
+                a.next_state.value = self.aggregate(a.state.value, v)
+
+            for j, actions in zip(active, active_actions):
+                ns = list(set([a.next_state for a in actions]) - seen[j])
+                ns.sort(key=lambda s: s.value, reverse=True)
+
+                beams[j] = ns[:beam_size]
+                histories[j].append(ns)
+                seen[j].update(ns)
+
+        return list(zip(successes, histories))
+
     def recover_solutions(self, rollout_history: list[list[State]]) -> list[list[State]]:
         '''Reconstructs the solutions (lists of states) from the history of a successful rollout.'''
 
@@ -96,11 +184,14 @@ class QFunction(nn.Module):
         pretrained_path = config.get('load_pretrained')
 
         if pretrained_path is not None:
-            pretrained_q_fn = torch.load(pretrained_path, map_location=device)
+            pretrained_q_fn = load_q_function(pretrained_path, device)
             pretrained_q_fn.to(device)
             return pretrained_q_fn
 
-        return QFunction.subtypes[config['type']](config, device)
+        q_fn = QFunction.subtypes[config['type']](config, device)
+        # Kept so that the model can be re-created when loading its weights with safetensors.
+        q_fn.config = config
+        return q_fn
 
     def name(self):
         raise NotImplementedError()
@@ -334,3 +425,60 @@ class RubiksGreedyHeuristic(QFunction):
             q.append((digits == self.target).float().mean().item())
 
         return torch.tensor(q, device=self.device)
+
+
+def serialize_q_function(q: QFunction) -> dict[str, bytes]:
+    '''Serializes a Q-function into the contents of the files written by save_q_function,
+    indexed by file extension.
+
+    If safetensors is available and the Q-function knows its config (i.e. it was
+    created by QFunction.new), tensors are stored in a .safetensors file and the
+    config in a small .pkl file. Otherwise, the whole module is saved with torch.save.'''
+    if SAFETENSORS_AVAILABLE and getattr(q, 'config', None) is not None:
+        tensors = {k: v.contiguous() for k, v in q.state_dict().items()}
+        metadata = {'type': type(q).__name__, 'config': q.config}
+        return {
+            '.safetensors': safetensors.torch.save(tensors),
+            '.pkl': pickle.dumps(metadata, protocol=pickle.HIGHEST_PROTOCOL),
+        }
+
+    buf = io.BytesIO()
+    torch.save(q, buf)
+    return {'.pt': buf.getvalue()}
+
+
+def save_q_function(q: QFunction, path: str):
+    'Saves a Q-function to be later loaded with load_q_function(path).'
+    base, _ = os.path.splitext(path)
+
+    for extension, data in serialize_q_function(q).items():
+        with open(base + extension, 'wb') as f:
+            f.write(data)
+
+
+def q_function_weights_path(path: str) -> str:
+    'Returns the file holding the weights of the Q-function saved at path.'
+    base, _ = os.path.splitext(path)
+    if os.path.exists(base + '.safetensors'):
+        return base + '.safetensors'
+    return path
+
+
+def load_q_function(path: str, device) -> QFunction:
+    'Loads a Q-function saved with save_q_function (or directly with torch.save).'
+    weights_path = q_function_weights_path(path)
+
+    if not weights_path.endswith('.safetensors'):
+        # Memory-maps the file instead of reading it all before moving tensors to the device.
+        return torch.load(path, map_location=device, mmap=True, weights_only=False)
+
+    if not SAFETENSORS_AVAILABLE:
+        raise RuntimeError(f'Loading {weights_path} requires the safetensors package')
+
+    with open(os.path.splitext(weights_path)[0] + '.pkl', 'rb') as f:
+        metadata = pickle.load(f)
+
+    q = QFunction.subtypes[metadata['type']](metadata['config'], device)
+    q.config = metadata['config']
+    q.load_state_dict(safetensors.torch.load_file(weights_path))
+    return q
@@ -236,22 +236,24 @@ class DKVMN_IRT(pl.LightningModule):
         ):
         super().__init__()
 
-        self.max_batch_size = batch_size
         self.n_questions = n_questions
         self.memory_size = memory_size
         self.memory_key_state_dim = config['hidden_size']
         self.memory_value_state_dim = config['hidden_size']
         self.summary_vector_output_dim = config['hidden_size']
 
-        self.init_key_memory = torch.randn(self.memory_size, self.memory_key_state_dim).to(device)
-        self.init_value_memory = torch.randn(self.memory_size, self.memory_value_state_dim).to(device)
+        # Buffers, so that they are moved along with the module and saved in its state_dict.
+        self.register_buffer('init_key_memory',
+                             torch.randn(self.memory_size, self.memory_key_state_dim))
+        self.register_buffer('init_value_memory',
+                             torch.randn(self.memory_size, self.memory_value_state_dim))
 
         self.memory = DKVMN(
             self.memory_size,
             self.memory_key_state_dim,
             self.memory_value_state_dim,
             self.init_key_memory,
-            self.init_value_memory.unsqueeze(0).repeat(batch_size, 1, 1),
+            self.init_value_memory,
         )
         self.q_embed_matrix = nn.Embedding(
             self.n_questions,
@@ -283,55 +285,48 @@ class DKVMN_IRT(pl.LightningModule):
         """
         batch_size, seq_len = q_data.size(0), q_data.size(1)
 
-        if batch_size < self.max_batch_size:
-            q_data = torch.cat([q_data,
-                                torch.zeros((self.max_batch_size - batch_size,
-                                             q_data.shape[1]),
-                                             device=q_data.device)])
-            qa_data = torch.cat([qa_data,
-                                 torch.zeros((self.max_batch_size - batch_size,
-                                              qa_data.shape[1]),
-                                              device=q_data.device)])
+        # Start every batch from the initial memory, sized to the actual batch.
+        # The buffers might have been moved to another device since the last call.
+        self.memory.memory_key = self.init_key_memory
+        self.memory.memory_value = (self.init_value_memory
+                                    .unsqueeze(0)
+                                    .expand(batch_size, -1, -1)
+                                    .contiguous())
 
         q_embed_data  = self.q_embed_matrix(q_data.long())
         qa_embed_data = self.qa_embed_matrix((0*q_data + qa_data.relu()).long())
 
-        sliced_q_embed_data = torch.chunk(q_embed_data, seq_len, dim=1)
-        sliced_qa_embed_data = torch.chunk(qa_embed_data, seq_len, dim=1)
-
-        pred_zs, student_abilities, question_difficulties = [], [], []
+        # Only the memory read/write is recurrent: everything else is computed
+        # for all timesteps at once below.
+        read_contents = []
 
         for i in range(seq_len):
-            q = sliced_q_embed_data[i].squeeze(1)
-            qa = sliced_qa_embed_data[i].squeeze(1)
+            q = q_embed_data[:, i]
+            qa = qa_embed_data[:, i]
 
             correlation_weight = self.memory.attention(q)
             read_content = self.memory.read(correlation_weight)
             new_memory_value = self.memory.write(correlation_weight, qa)
 
-            mastery_level_prior_difficulty = torch.cat([read_content, q], dim=1)
+            read_contents.append(read_content)
 
-            summary_vector = self.summary_vector_fc(
-                mastery_level_prior_difficulty,
-            )
-            summary_vector = torch.tanh(summary_vector)
-            student_ability = self.student_ability_fc(summary_vector)
-            question_difficulty = self.question_difficulty_fc(q)
-            question_difficulty = torch.tanh(question_difficulty)
+        # (batch_size, seq_len, memory_value_state_dim)
+        read_contents = torch.stack(read_contents, dim=1)
 
-            pred_z = 3.0 * student_ability - question_difficulty
+        mastery_level_prior_difficulty = torch.cat([read_contents, q_embed_data], dim=2)
 
-            pred_zs.append(pred_z)
-            student_abilities.append(student_ability)
-            question_difficulties.append(question_difficulty)
+        summary_vector = self.summary_vector_fc(
+            mastery_level_prior_difficulty,
+        )
+        summary_vector = torch.tanh(summary_vector)
+        # (batch_size, seq_len)
+        student_abilities = self.student_ability_fc(summary_vector).squeeze(2)
+        question_difficulties = self.question_difficulty_fc(q_embed_data)
+        question_difficulties = torch.tanh(question_difficulties).squeeze(2)
 
-        pred_zs = torch.cat(pred_zs, dim=1)
-        student_abilities = torch.cat(student_abilities, dim=1)
-        question_difficulties = torch.cat(question_difficulties, dim=1)
+        pred_zs = 3.0 * student_abilities - question_difficulties
 
-        return (pred_zs[:batch_size],
-                student_abilities[:batch_size],
-                question_difficulties[:batch_size])
+        return pred_zs, student_abilities, question_difficulties
 
     def get_loss(
             self,
@@ -371,9 +366,9 @@ class DKVMN_IRT(pl.LightningModule):
 
     def training_step(self, batch, batch_idx):
         index, response, problem_id, mask = batch
-        response = response.to(self.device)
-        problem_id = problem_id.to(self.device)
-        mask = mask.to(self.device)
+        response = response.to(self.device, non_blocking=True)
+        problem_id = problem_id.to(self.device, non_blocking=True)
+        mask = mask.to(self.device, non_blocking=True)
         pred_zs, student_abilities, question_difficulties = self(problem_id, response)
         loss, accuracy, auroc = self.get_loss(pred_zs, student_abilities, question_difficulties,
                                               response)
@@ -388,9 +383,9 @@ class DKVMN_IRT(pl.LightningModule):
     def test_step(self, batch, batch_idx, prefix='test', log=True):
         with torch.no_grad():
             index, response, problem_id, mask = batch
-            response = response.to(self.device)
-            problem_id = problem_id.to(self.device)
-            mask = mask.to(self.device)
+            response = response.to(self.device, non_blocking=True)
+            problem_id = problem_id.to(self.device, non_blocking=True)
+            mask = mask.to(self.device, non_blocking=True)
             pred_zs, student_abilities, question_difficulties = self(problem_id, response)
             loss, accuracy, auroc = self.get_loss(pred_zs, student_abilities, question_difficulties,
                                                   response)
@@ -402,7 +397,13 @@ class DKVMN_IRT(pl.LightningModule):
             return metrics
 
     def configure_optimizers(self):
-        return torch.optim.Adam(self.parameters(), lr=self.lr)
+        # The fused implementation is only available for CUDA parameters.
+        if self.device.type == 'cuda':
+            return torch.optim.Adam(self.parameters(), lr=self.lr, fused=True)
+        return torch.optim.Adam(self.parameters(), lr=self.lr, foreach=True)
+
+    def optimizer_zero_grad(self, epoch, batch_idx, optimizer, optimizer_idx):
+        optimizer.zero_grad(set_to_none=True)
 
 class DKVMN(nn.Module):
     """Adapted from the TensorFlow implementation.
@@ -448,16 +449,32 @@ class DKVMN(nn.Module):
         return read_content
 
     def write(self, c_weight, qa_embedded):
-        batch_size = c_weight.size(0)
-        memory_value = self.value.write(
-            self.memory_value,
-            c_weight,
-            qa_embedded,
-        )
-        self.memory_value = memory_value.detach()
+        # Gradients do not flow across timesteps through the memory, so there's
+        # no need to build the backward graph for the update.
+        with torch.no_grad():
+            memory_value = self.value.write(
+                self.memory_value,
+                c_weight,
+                qa_embedded,
+            )
+        self.memory_value = memory_value
         return memory_value
 
 
+@torch.jit.script
+def fused_memory_write(value_matrix, erase_vector, add_vector, correlation_weight):
+    """Erase-then-add memory update, scripted so the elementwise ops get fused.
+
+    value_matrix: (batch_size, memory_size, memory_state_dim)
+    erase_vector, add_vector: (batch_size, memory_state_dim)
+    correlation_weight: (batch_size, memory_size)
+    """
+    erase_signal = torch.sigmoid(erase_vector).unsqueeze(1)
+    add_signal = torch.tanh(add_vector).unsqueeze(1)
+    cw = correlation_weight.unsqueeze(2)
+    return value_matrix * (1 - erase_signal * cw) + add_signal * cw
+
+
 class DKVMN_Memory(nn.Module):
     """
     https://github.com/yjhong89/DKVMN/blob/master/memory.py
@@ -487,22 +504,8 @@ class DKVMN_Memory(nn.Module):
         value_matrix: (batch_size, memory_size, memory_state_dim)
         correlation_weight: (batch_size, memory_size)
         """
-        batch_size = value_matrix.size(0)
-        vmtx_reshaped = value_matrix.view(
-            batch_size * self.memory_size,
-            self.memory_state_dim,
-        )
-        cw_reshaped = correlation_weight.view(
-            batch_size * self.memory_size,
-            1
-        )
-        rc = vmtx_reshaped * cw_reshaped
-        read_content = rc.view(
-            batch_size,
-            self.memory_size,
-            self.memory_state_dim,
-        )
-        read_content = torch.sum(read_content, dim=1)
+        # (batch_size, 1, memory_size) x (batch_size, memory_size, memory_state_dim)
+        read_content = torch.bmm(correlation_weight.unsqueeze(1), value_matrix).squeeze(1)
 
         return read_content
 
@@ -512,41 +515,11 @@ class DKVMN_Memory(nn.Module):
         correlation_weight: (batch_size, memory_size)
         qa_embedded: (batch_size, memory_state_dim)
         """
-        batch_size = value_matrix.size(0)
-
         erase_vector = self.erase_linear(qa_embedded)
-        # (batch_size, memory_state_dim)
-        erase_signal = torch.sigmoid(erase_vector)
-
         add_vector = self.add_linear(qa_embedded)
-        # (batch_size, memory_state_dim)
-        add_signal = torch.tanh(add_vector)
 
-        erase_reshaped = erase_signal.view(
-            batch_size,
-            1,
-            self.memory_state_dim,
-        )
-        cw_reshaped = correlation_weight.view(
-            batch_size,
-            self.memory_size,
-            1,
-        )
-        erase_mul = erase_reshaped * cw_reshaped
         # (batch_size, memory_size, memory_state_dim)
-        erase = value_matrix * (1 - erase_mul)
-
-        # (batch_size, 1, memory_state_dim)
-        add_reshaped = add_signal.view(
-            batch_size,
-            1,
-            self.memory_state_dim,
-        )
-        add_mul = add_reshaped * cw_reshaped
-
-        new_memory = erase + add_mul
-        # (batch_size, memory_size, memory_state_dim)
-        return new_memory
+        return fused_memory_write(value_matrix, erase_vector, add_vector, correlation_weight)
 
 def split_train_val_test(d, frac_train, frac_val, split_seed=0):
     idx = list(range(len(d)))
@@ -636,9 +609,16 @@ def run_experiments(config):
             config['val_fraction'],
             config['split_seed'])
 
-    train_dataloader = torch.utils.data.DataLoader(training_set, batch_size=batch_size)
-    val_dataloader = torch.utils.data.DataLoader(val_set, batch_size=batch_size)
-    test_dataloader = torch.utils.data.DataLoader(test_set, batch_size=batch_size)
+    # Load batches in background workers, into pinned memory when training on the GPU.
+    num_workers = config.get('num_workers', (os.cpu_count() or 1) // 2)
+    loader_options = dict(batch_size=batch_size,
+                          num_workers=num_workers,
+                          pin_memory=device.type == 'cuda',
+                          persistent_workers=num_workers > 0)
+
+    train_dataloader = torch.utils.data.DataLoader(training_set, **loader_options)
+    val_dataloader = torch.utils.data.DataLoader(val_set, **loader_options)
+    test_dataloader = torch.utils.data.DataLoader(test_set, **loader_options)
 
     trainer = pl.Trainer(gpus=gpus,
                          logger=pl.loggers.wandb.WandbLogger(config.get('name', 'DeepIRT')),
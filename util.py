@@ -2,6 +2,8 @@
 
 import random
 import datetime
+import pickle
+import pickletools
 
 
 def format_eta(elapsed_time, elapsed_steps, total_steps):
@@ -25,3 +27,30 @@ def register(superclass):
 def now():
     'The current time as string, to be printed in log messages.'
     return datetime.datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
+
+
+def append_to_pickle_log(path, record):
+    'Appends one record to an append-only log of pickled objects.'
+    data = pickletools.optimize(pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL))
+
+    with open(path, 'ab') as f:
+        f.write(data)
+
+
+def load_pickle_log(path):
+    'Loads all records from a log written by append_to_pickle_log.'
+    records = []
+
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                record = pickle.load(f)
+            except EOFError:
+                break
+            # Older logs were a single pickled list with all records.
+            if isinstance(record, list):
+                records.extend(record)
+            else:
+                records.append(record)
+
+    return records